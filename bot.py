@@ -2,36 +2,146 @@ import os
 import logging
 import asyncio
 import re
+from collections import defaultdict
+from typing import NamedTuple
+import numpy as np
+import pandas as pd
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ChatPermissions
+from telegram.error import RetryAfter
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
 from datetime import datetime, timedelta
 import pytz
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from sqlalchemy import create_engine, Column, Integer, String, JSON, DateTime, Boolean, Float, ForeignKey
-from sqlalchemy.orm import declarative_base, sessionmaker, relationship
+from aiolimiter import AsyncLimiter
+from cachetools import TTLCache
+from sqlalchemy import select, update, delete, func, bindparam, text, Column, Integer, String, DateTime, Boolean, Float, ForeignKey, Index, UniqueConstraint
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB, insert as pg_insert
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.orm import declarative_base, relationship
 from fastapi import FastAPI, Request
 from starlette.responses import Response
 
+import technical_analysis
+
 # Configuration
 TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 WEBHOOK_URL = os.getenv('WEBHOOK_URL')
 PORT = int(os.getenv('PORT', 8000))
+# Telegram's global broadcast limit is about 30 messages per second
+SEND_RATE_LIMIT = 30
+# Cap on sends in flight at once, so a large fan-out doesn't queue hundreds
+# of requests on the HTTP pool
+SEND_CONCURRENCY = 20
+# Minimum spacing between two sends to the same chat; Telegram allows a
+# group about 20 messages a minute (seconds)
+CHAT_SEND_INTERVAL = 3
+# How long a rendered stock analysis is reused during trading hours (seconds)
+ANALYSIS_CACHE_TTL = 300
+# How long a group's id and settings are served from memory (seconds)
+GROUP_CACHE_TTL = 60
 SAUDI_TIMEZONE = pytz.timezone('Asia/Riyadh')
-STOCK_SYMBOLS = ['1211.SR', '2222.SR', '3030.SR', '4200.SR']
-ACTIVATED_GROUPS = set(os.getenv('ACTIVATED_GROUPS', '').split(','))
-DATABASE_URL = os.getenv('DATABASE_URL').replace("postgres://", "postgresql://", 1)
+STOCK_SYMBOLS = ('1211.SR', '2222.SR', '3030.SR', '4200.SR')
+STOCK_TICKERS = ' '.join(STOCK_SYMBOLS)
+# Trading days of hourly bars the opportunity scan looks at
+SCAN_WINDOW_DAYS = 3
+ACTIVATED_GROUPS = frozenset(chat_id for chat_id in os.getenv('ACTIVATED_GROUPS', '').split(',') if chat_id)
+# Tadawul trades Sunday-Thursday (Python weekdays 6, 0-3), 10:00-15:00 Riyadh
+TRADING_DAYS = {6, 0, 1, 2, 3}
+TRADING_HOURS = {'start': (10, 0), 'end': (15, 0)}
+# The same bounds as minutes since midnight, for a plain integer compare
+TRADING_START_MINUTE = TRADING_HOURS['start'][0] * 60 + TRADING_HOURS['start'][1]
+TRADING_END_MINUTE = TRADING_HOURS['end'][0] * 60 + TRADING_HOURS['end'][1]
+STRATEGY_NAMES = {
+    'golden': 'ذهبية 💰',
+    'earthquake': 'زلزالية 🌋',
+    'volcano': 'بركانية 🌋',
+    'lightning': 'برقية ⚡'
+}
+# Target price multipliers per strategy (entry * (1 + i*step)), built once
+TARGET_MULTIPLIERS = {
+    'golden': 1 + 0.05 * np.arange(1, 5),
+    'earthquake': 1 + 0.08 * np.arange(1, 3),
+    'volcano': 1 + 0.1 * np.arange(1, 6),
+    'lightning': 1 + 0.07 * np.arange(1, 3)
+}
+STOCK_CODE_PATTERN = re.compile(r'\d{4}')
+# Phone numbers and links/ads; compiled once instead of on every message
+SPAM_PATTERNS = (
+    re.compile(r'(?:\+?966|0)?\d{10}'),
+    re.compile(r'whatsapp|telegram|t\.me|http|www|\.com|إعلان|اتصل بنا', re.IGNORECASE)
+)
+# Opportunity alert, rendered once per opportunity and sent as-is to every group
+ALERT_TEMPLATE = (
+    "🚨 إشارة {strategy}\n"
+    "📈 السهم: {symbol}\n"
+    "💰 السعر: {entry_price:.2f}\n"
+    "🎯 الأهداف: {targets}\n"
+    "🛑 وقف الخسارة: {stop_loss:.2f}"
+)
+# (header, per-group body) for each scheduled report
+REPORT_TEMPLATES = {
+    'daily': (
+        "📊 *التقرير اليومي*\n"
+        "📅 التاريخ: {now:%Y-%m-%d}\n"
+        "⏰ الوقت: {now:%H:%M}\n\n",
+        "📈 عدد الفرص اليوم: {opportunities}\n"
+        "👥 عدد المستخدمين النشطين: {users}"
+    ),
+    'weekly': (
+        "📊 *التقرير الأسبوعي*\n"
+        "📅 الأسبوع: {now:%Y-%U}\n"
+        "⏰ الوقت: {now:%H:%M}\n\n",
+        "📈 عدد الفرص الأسبوعية: {opportunities}\n"
+        "👥 عدد المستخدمين النشطين: {users}"
+    )
+}
+# The menus never change, so their markups are built once and shared
+SUPPORT_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("تواصل مع الدعم 📞", url='t.me/support')]
+])
+MAIN_MENU_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("الإعدادات ⚙️", callback_data='settings'),
+     InlineKeyboardButton("التقارير 📊", callback_data='reports')],
+    [InlineKeyboardButton("الدعم الفني 📞", url='t.me/support')]
+])
+SETTINGS_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("تعديل الإعدادات", callback_data='edit_settings')],
+    [InlineKeyboardButton("رجوع ↩️", callback_data='main_menu')]
+])
+EDIT_SETTINGS_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("تعديل عدد الاستفسارات", callback_data='edit_queries')],
+    [InlineKeyboardButton("تعديل نوع العقوبة", callback_data='edit_penalty')],
+    [InlineKeyboardButton("تفعيل/تعطيل الاستراتيجيات", callback_data='toggle_strategies')],
+    [InlineKeyboardButton("رجوع ↩️", callback_data='settings')]
+])
+DATABASE_URL = re.sub(r'^postgres(?:ql)?://', 'postgresql+asyncpg://', os.getenv('DATABASE_URL'))
 
 # Initialize database
 Base = declarative_base()
-engine = create_engine(DATABASE_URL)
-Session = sessionmaker(bind=engine)
+# asyncpg keeps queries on the event loop instead of blocking it the way a
+# synchronous driver does inside handlers and scheduled jobs.
+# pool_pre_ping/pool_recycle keep pooled connections usable across the idle
+# stretches between scheduled jobs; the statement timeout stops one stuck
+# query from pinning a pooled connection indefinitely.
+engine = create_async_engine(
+    DATABASE_URL,
+    pool_size=20,
+    max_overflow=10,
+    pool_pre_ping=True,
+    pool_recycle=1800,
+    pool_reset_on_return='rollback',
+    connect_args={'server_settings': {'statement_timeout': '10000'}}
+)
+# Objects stay readable after commit without a lazy refresh, which async
+# sessions can't do implicitly.
+Session = async_sessionmaker(engine, expire_on_commit=False)
 
 # Database Models
 class Group(Base):
     __tablename__ = 'groups'
     id = Column(Integer, primary_key=True)
     chat_id = Column(String, unique=True)
-    settings = Column(JSON, default={
+    settings = Column(JSONB, default={
         'reports': {'hourly': True, 'daily': True, 'weekly': True},
         'strategies': {
             'golden': True, 'earthquake': True,
@@ -45,49 +155,247 @@ class Group(Base):
     opportunities = relationship('Opportunity', back_populates='group')
     users = relationship("User", back_populates="group")
 
+    # Report fan-out filters groups with JSONB containment (@>), which this
+    # GIN index serves without scanning every row. jsonb_path_ops only
+    # supports @>, which is all we query with, and is smaller and faster
+    # for it than the default opclass.
+    __table_args__ = (
+        Index(
+            'ix_groups_settings_gin', 'settings',
+            postgresql_using='gin',
+            postgresql_ops={'settings': 'jsonb_path_ops'}
+        ),
+    )
+
 class User(Base):
     __tablename__ = 'users'
     id = Column(Integer, primary_key=True)
     user_id = Column(String)
     daily_queries = Column(Integer, default=0)
-    last_query = Column(DateTime)
+    last_query = Column(DateTime(timezone=True))
     group_id = Column(Integer, ForeignKey('groups.id'))
     group = relationship("Group", back_populates="users")
     penalties = relationship("Penalty", back_populates="user")
 
+    # The unique constraint leads with user_id, so report counts per group
+    # need their own index
+    __table_args__ = (
+        UniqueConstraint('user_id', 'group_id', name='uq_users_user_group'),
+        Index('ix_users_group_id', 'group_id'),
+    )
+
 class Penalty(Base):
     __tablename__ = 'penalties'
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'))
     penalty_type = Column(String)
-    start_time = Column(DateTime)
-    end_time = Column(DateTime)
+    start_time = Column(DateTime(timezone=True))
+    end_time = Column(DateTime(timezone=True))
     user = relationship("User", back_populates="penalties")
 
+    # The penalty sweep selects expired rows by end_time every 30 minutes
+    __table_args__ = (
+        Index('ix_penalties_end_time', 'end_time'),
+    )
+
 class Opportunity(Base):
     __tablename__ = 'opportunities'
     id = Column(Integer, primary_key=True)
     symbol = Column(String)
     strategy = Column(String)
     entry_price = Column(Float)
-    targets = Column(JSON)
+    targets = Column(ARRAY(Float))
     stop_loss = Column(Float)
     current_target = Column(Integer, default=0)
     status = Column(String, default='active')
     group_id = Column(Integer, ForeignKey('groups.id'))
     group = relationship('Group', back_populates='opportunities')
-    created_at = Column(DateTime, default=lambda: datetime.now(SAUDI_TIMEZONE))
+    created_at = Column(DateTime(timezone=True), default=lambda: datetime.now(SAUDI_TIMEZONE))
+
+    __table_args__ = (
+        Index('ix_opportunities_group_id', 'group_id'),
+    )
 
-Base.metadata.create_all(engine)
+# Hot statements are built once; per call only the parameters are bound
+GROUP_BY_CHAT_ID = select(Group).where(Group.chat_id == bindparam('chat_id'))
+# Subscribed groups with their user and opportunity counts in one round
+# trip; each count is an index lookup on its group_id
+REPORT_COUNTS_BY_GROUP = (
+    select(
+        Group.chat_id,
+        select(func.count(User.id)).where(User.group_id == Group.id).scalar_subquery(),
+        select(func.count(Opportunity.id)).where(Opportunity.group_id == Group.id).scalar_subquery()
+    )
+    .where(
+        Group.chat_id.in_(bindparam('chat_ids', expanding=True)),
+        Group.settings.contains(bindparam('settings', type_=JSONB))
+    )
+)
+RESET_DAILY_QUERIES = update(User).values(daily_queries=0)
+# Quota check and count in one statement: a query is only answered if this
+# returns the user's id, so concurrent codes from one user can't all pass a
+# check made before any of them was counted
+RESERVE_USER_QUERY = (
+    update(User)
+    .where(User.id == bindparam('user_pk'), User.daily_queries < bindparam('max_queries'))
+    .values(daily_queries=User.daily_queries + 1, last_query=bindparam('queried_at'))
+    .returning(User.id)
+)
+# Gives a reserved query back when it couldn't be answered
+RELEASE_USER_QUERY = (
+    update(User)
+    .where(User.id == bindparam('user_pk'), User.daily_queries > 0)
+    .values(daily_queries=User.daily_queries - 1)
+)
+
+# create_all() only builds missing tables, so databases created before the
+# current schema are brought up to it here. Every step checks the catalog
+# first, making the whole list safe to run on each startup.
+SCHEMA_UPGRADES = tuple(text(statement) for statement in (
+    # settings json -> jsonb, for @> containment and its GIN index
+    """
+    DO $$ BEGIN
+        IF (SELECT data_type FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = 'groups'
+              AND column_name = 'settings') = 'json' THEN
+            ALTER TABLE groups ALTER COLUMN settings TYPE jsonb USING settings::jsonb;
+        END IF;
+    END $$
+    """,
+    # An index built with the default jsonb opclass is replaced by the
+    # jsonb_path_ops one the model declares
+    """
+    DO $$ BEGIN
+        IF EXISTS (SELECT 1 FROM pg_indexes
+                   WHERE schemaname = current_schema() AND indexname = 'ix_groups_settings_gin'
+                     AND indexdef NOT LIKE '%jsonb_path_ops%') THEN
+            DROP INDEX ix_groups_settings_gin;
+        END IF;
+    END $$
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_groups_settings_gin ON groups USING gin (settings jsonb_path_ops)",
+    # Duplicate (user_id, group_id) rows are merged into the oldest one
+    # before the constraint the user upsert conflicts on is added
+    """
+    DO $$ BEGIN
+        IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'uq_users_user_group') THEN
+            UPDATE penalties SET user_id = keep.id
+            FROM users dup JOIN users keep
+              ON keep.user_id = dup.user_id AND keep.group_id = dup.group_id AND keep.id < dup.id
+            WHERE penalties.user_id = dup.id
+              AND NOT EXISTS (SELECT 1 FROM users older
+                              WHERE older.user_id = keep.user_id AND older.group_id = keep.group_id
+                                AND older.id < keep.id);
+            DELETE FROM users dup USING users keep
+            WHERE keep.user_id = dup.user_id AND keep.group_id = dup.group_id AND keep.id < dup.id;
+            ALTER TABLE users ADD CONSTRAINT uq_users_user_group UNIQUE (user_id, group_id);
+        END IF;
+    END $$
+    """,
+    # targets json -> double precision[]; a subquery can't be used in
+    # ALTER COLUMN ... USING, so the values are copied over via a new column
+    """
+    DO $$ BEGIN
+        IF (SELECT data_type FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = 'opportunities'
+              AND column_name = 'targets') IN ('json', 'jsonb') THEN
+            ALTER TABLE opportunities RENAME COLUMN targets TO targets_json;
+            ALTER TABLE opportunities ADD COLUMN targets double precision[];
+            UPDATE opportunities
+            SET targets = ARRAY(SELECT jsonb_array_elements_text(targets_json::jsonb)::float8)
+            WHERE jsonb_typeof(targets_json::jsonb) = 'array';
+            ALTER TABLE opportunities DROP COLUMN targets_json;
+        END IF;
+    END $$
+    """,
+    # Naive timestamps -> timestamptz; asyncpg rejects aware datetimes for
+    # plain timestamp columns
+    """
+    DO $$
+    DECLARE col record;
+    BEGIN
+        FOR col IN
+            SELECT table_name, column_name FROM information_schema.columns
+            WHERE table_schema = current_schema() AND data_type = 'timestamp without time zone'
+              AND (table_name, column_name) IN (('users', 'last_query'), ('penalties', 'start_time'),
+                                                ('penalties', 'end_time'), ('opportunities', 'created_at'))
+        LOOP
+            EXECUTE format('ALTER TABLE %I ALTER COLUMN %I TYPE timestamptz', col.table_name, col.column_name);
+        END LOOP;
+    END $$
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_users_group_id ON users (group_id)",
+    "CREATE INDEX IF NOT EXISTS ix_penalties_end_time ON penalties (end_time)",
+    "CREATE INDEX IF NOT EXISTS ix_opportunities_group_id ON opportunities (group_id)"
+))
+
+async def init_db():
+    async with engine.begin() as conn:
+        # The pool's 10 s statement timeout is for request traffic; a table
+        # rewrite or index build here may take longer, and a timeout would
+        # stop the app from starting at all
+        await conn.execute(text("SET LOCAL statement_timeout = 0"))
+        await conn.run_sync(Base.metadata.create_all)
+        for statement in SCHEMA_UPGRADES:
+            await conn.execute(statement)
 
 # Create FastAPI app for webhook handling
 app = FastAPI()
 
+# Scan Data
+class Bars(NamedTuple):
+    """The columns the opportunity detectors read, as contiguous arrays."""
+    high: np.ndarray
+    low: np.ndarray
+    close: np.ndarray
+    volume: np.ndarray
+
+    @classmethod
+    def from_frame(cls, data):
+        return cls(*(
+            np.ascontiguousarray(data[column], dtype=np.float64)
+            for column in ('High', 'Low', 'Close', 'Volume')
+        ))
+
 # Saudi Stock Bot Class
 class SaudiStockBot:
     def __init__(self):
-        self.app = Application.builder().token(TOKEN).build()
-        self.scheduler = AsyncIOScheduler(timezone=SAUDI_TIMEZONE)
+        # Bot API calls keep PTB's default connection pool; HTTP/2 lets the
+        # broadcast fan-out and handler replies multiplex over it.
+        self.app = (
+            Application.builder()
+            .token(TOKEN)
+            .http_version('2')
+            .concurrent_updates(True)
+            .build()
+        )
+        # A scan that overruns its interval shouldn't pile up a second copy,
+        # and runs missed while the loop was busy collapse into one.
+        self.scheduler = AsyncIOScheduler(
+            timezone=SAUDI_TIMEZONE,
+            job_defaults={'coalesce': True, 'max_instances': 1, 'misfire_grace_time': 300}
+        )
+        self.send_limiter = AsyncLimiter(SEND_RATE_LIMIT, 1)
+        self.send_semaphore = asyncio.Semaphore(SEND_CONCURRENCY)
+        # chat id -> loop time before which the next send to it must wait
+        self.chat_next_send = defaultdict(float)
+        # symbol -> hourly bars for the last SCAN_WINDOW_DAYS trading days
+        self.bar_cache = {}
+        # symbol -> (timestamp of the last completed bar, ema50, ema200,
+        #            whether EMA50 was above EMA200 at the previous scan)
+        self.ema_state = {}
+        self.analysis_cache = TTLCache(maxsize=1024, ttl=ANALYSIS_CACHE_TTL)
+        # chat id -> (group id, settings)
+        self.group_cache = TTLCache(maxsize=10000, ttl=GROUP_CACHE_TTL)
+        # stock code -> (last closed session's date, analysis text), used
+        # while the market is closed
+        self.closed_market_analysis = {}
+        # callback data -> handler, looked up once per button tap
+        self.button_handlers = {
+            'settings': self.settings,
+            'edit_settings': self.edit_settings,
+            'main_menu': self.back_to_main_menu
+        }
         self.setup_handlers()
 
     def setup_handlers(self):
@@ -98,7 +406,12 @@ class SaudiStockBot:
         self.app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_message))
 
     async def run(self):
+        await init_db()
+        # Off the loop: a cold numba cache takes a few seconds to compile
+        await asyncio.to_thread(technical_analysis.warmup)
         await self.app.initialize()
+        # Starts the update-queue consumer the webhook feeds
+        await self.app.start()
         self.scheduler.start()
 
         # Setup scheduled jobs
@@ -112,7 +425,12 @@ class SaudiStockBot:
         await self.setup_webhook()
 
         logging.info("Bot is running...")
-        await asyncio.Event().wait()
+
+    async def stop(self):
+        self.scheduler.shutdown(wait=False)
+        await self.app.stop()
+        await self.app.shutdown()
+        await engine.dispose()
 
     async def setup_webhook(self):
         """Set up and test the webhook."""
@@ -130,21 +448,15 @@ class SaudiStockBot:
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         chat_id = str(update.effective_chat.id)
         if chat_id not in ACTIVATED_GROUPS:
-            keyboard = [[InlineKeyboardButton("تواصل مع الدعم 📞", url='t.me/support')]]
             await update.message.reply_text(
                 "⚠️ هذه المجموعة غير مفعلة! لتفعيلها يرجى التواصل مع الدعم الفني.",
-                reply_markup=InlineKeyboardMarkup(keyboard)
+                reply_markup=SUPPORT_KEYBOARD
             )
             return
 
-        keyboard = [
-            [InlineKeyboardButton("الإعدادات ⚙️", callback_data='settings'),
-             InlineKeyboardButton("التقارير 📊", callback_data='reports')],
-            [InlineKeyboardButton("الدعم الفني 📞", url='t.me/support')]
-        ]
         await update.message.reply_text(
             "مرحبًا بكم في بوت الأسهم السعودية المتقدم! 📈",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=MAIN_MENU_KEYBOARD
         )
 
     async def settings(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -152,13 +464,12 @@ class SaudiStockBot:
         if chat_id not in ACTIVATED_GROUPS:
             return
 
-        session = Session()
         try:
-            group = session.query(Group).filter_by(chat_id=chat_id).first()
-            if not group:
-                group = Group(chat_id=chat_id)
-                session.add(group)
-                session.commit()
+            # Session.begin() commits on a clean exit and rolls back if the
+            # block raises, with the connection checked out once
+            async with Session.begin() as session:
+                group = await self.get_or_create_group(session, chat_id)
+            self.group_cache[chat_id] = (group.id, group.settings)
 
             settings_text = (
                 "⚙️ إعدادات المجموعة:\n\n"
@@ -172,47 +483,62 @@ class SaudiStockBot:
                 f"- برقية: {'✅' if group.settings['strategies']['lightning'] else '❌'}"
             )
 
-            buttons = [
-                [InlineKeyboardButton("تعديل الإعدادات", callback_data='edit_settings')],
-                [InlineKeyboardButton("رجوع ↩️", callback_data='main_menu')]
-            ]
-
             await update.message.reply_text(
                 settings_text,
-                reply_markup=InlineKeyboardMarkup(buttons)
+                reply_markup=SETTINGS_KEYBOARD
             )
         except Exception as e:
             logging.error(f"Settings Error: {str(e)}", exc_info=True)
-        finally:
-            session.close()
+
+    async def get_or_create_group(self, session, chat_id):
+        # A single INSERT ... ON CONFLICT ... RETURNING replaces the
+        # SELECT-then-INSERT round trips (and can't race a concurrent insert).
+        stmt = pg_insert(Group).values(chat_id=chat_id)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['chat_id'],
+            set_={'chat_id': stmt.excluded.chat_id}
+        ).returning(Group)
+        result = await session.scalars(stmt, execution_options={'populate_existing': True})
+        return result.one()
+
+    async def get_group_settings(self, session, chat_id):
+        # Every stock query and spam hit needs the group's id and settings,
+        # which rarely change; keep them per chat for GROUP_CACHE_TTL
+        cached = self.group_cache.get(chat_id)
+        if cached is None:
+            group = await session.scalar(GROUP_BY_CHAT_ID, {'chat_id': chat_id})
+            cached = self.group_cache[chat_id] = (group.id, group.settings)
+        return cached
+
+    async def get_or_create_user(self, session, user_id, group_id):
+        stmt = pg_insert(User).values(user_id=user_id, group_id=group_id)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['user_id', 'group_id'],
+            set_={'user_id': stmt.excluded.user_id}
+        ).returning(User)
+        result = await session.scalars(stmt, execution_options={'populate_existing': True})
+        return result.one()
 
     async def handle_button(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         query = update.callback_query
         await query.answer()
 
-        if query.data == 'settings':
-            await self.settings(update, context)
-        elif query.data == 'edit_settings':
-            await self.edit_settings(update)
-        elif query.data == 'main_menu':
-            await query.message.delete()
-            await self.start(update, context)
+        handler = self.button_handlers.get(query.data)
+        if handler is not None:
+            await handler(update, context)
+
+    async def back_to_main_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        await update.callback_query.message.delete()
+        await self.start(update, context)
 
-    async def edit_settings(self, update: Update):
+    async def edit_settings(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         chat_id = str(update.callback_query.message.chat.id)
         if chat_id not in ACTIVATED_GROUPS:
             return
 
-        keyboard = [
-            [InlineKeyboardButton("تعديل عدد الاستفسارات", callback_data='edit_queries')],
-            [InlineKeyboardButton("تعديل نوع العقوبة", callback_data='edit_penalty')],
-            [InlineKeyboardButton("تفعيل/تعطيل الاستراتيجيات", callback_data='toggle_strategies')],
-            [InlineKeyboardButton("رجوع ↩️", callback_data='settings')]
-        ]
-
         await update.callback_query.message.edit_text(
             "🛠 اختر الإعداد الذي تريد تعديله:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=EDIT_SETTINGS_KEYBOARD
         )
 
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -223,42 +549,33 @@ class SaudiStockBot:
         message = update.message.text
         user_id = str(update.effective_user.id)
 
-        if self.is_spam(message):
-            await self.handle_spam(update)
+        # A bare 4-digit code can never match the spam patterns, so check it first
+        if STOCK_CODE_PATTERN.fullmatch(message):
+            await self.handle_stock_analysis(user_id, message, update)
             return
 
-        if re.fullmatch(r'^\d{4}$', message):
-            await self.handle_stock_analysis(user_id, message, update)
+        if self.is_spam(message):
+            await self.handle_spam(update)
 
     def is_spam(self, message):
-        patterns = [
-            r'(?:\+?966|0)?\d{10}',
-            r'whatsapp|telegram|t\.me|http|www|\.com|إعلان|اتصل بنا'
-        ]
-        return any(re.search(pattern, message, re.IGNORECASE) for pattern in patterns)
+        return any(pattern.search(message) for pattern in SPAM_PATTERNS)
 
     async def handle_spam(self, update: Update):
         await update.message.delete()
-        session = Session()
         try:
             user_id = str(update.message.from_user.id)
             chat_id = str(update.message.chat.id)
-            group = session.query(Group).filter_by(chat_id=chat_id).first()
-            user = session.query(User).filter_by(user_id=user_id, group_id=group.id).first()
-
-            if not user:
-                user = User(user_id=user_id, group_id=group.id)
-                session.add(user)
-                session.commit()
-
-            penalty = Penalty(
-                user_id=user.id,
-                penalty_type=group.settings['security']['penalty']['type'],
-                start_time=datetime.now(SAUDI_TIMEZONE),
-                end_time=datetime.now(SAUDI_TIMEZONE) + timedelta(hours=group.settings['security']['penalty']['duration'])
-            )
-            session.add(penalty)
-            session.commit()
+            async with Session.begin() as session:
+                group_id, settings = await self.get_group_settings(session, chat_id)
+                user = await self.get_or_create_user(session, user_id, group_id)
+
+                penalty = Penalty(
+                    user_id=user.id,
+                    penalty_type=settings['security']['penalty']['type'],
+                    start_time=datetime.now(SAUDI_TIMEZONE),
+                    end_time=datetime.now(SAUDI_TIMEZONE) + timedelta(hours=settings['security']['penalty']['duration'])
+                )
+                session.add(penalty)
 
             if penalty.penalty_type == 'mute':
                 await update.message.chat.restrict_member(
@@ -275,271 +592,411 @@ class SaudiStockBot:
             )
         except Exception as e:
             logging.error(f"Spam Handling Error: {str(e)}", exc_info=True)
-        finally:
-            session.close()
 
     async def handle_stock_analysis(self, user_id, stock_code, update: Update):
-        session = Session()
+        # Set once a query has been charged to the user and not yet answered
+        reserved = None
         try:
-            group = session.query(Group).filter_by(chat_id=str(update.message.chat.id)).first()
-            user = session.query(User).filter_by(user_id=user_id, group_id=group.id).first()
-
-            if not user:
-                user = User(user_id=user_id, group_id=group.id)
-                session.add(user)
-                session.commit()
-
-            if user.daily_queries >= group.settings['security']['max_queries']:
+            # The query is reserved against the quota in one short transaction
+            # before the download, so no pooled connection or user row lock is
+            # held across the network calls that follow.
+            async with Session.begin() as session:
+                group_id, settings = await self.get_group_settings(session, str(update.message.chat.id))
+                user = await self.get_or_create_user(session, user_id, group_id)
+                user_pk = await session.scalar(RESERVE_USER_QUERY, {
+                    'user_pk': user.id,
+                    'max_queries': settings['security']['max_queries'],
+                    'queried_at': datetime.now(SAUDI_TIMEZONE)
+                })
+
+            if user_pk is None:
                 await update.message.reply_text("⚠️ لقد تجاوزت الحد الأقصى للاستفسارات اليومية!")
                 return
 
+            reserved = user_pk
             analysis = await self.analyze_stock(stock_code)
             sent_message = await update.message.reply_text(analysis, parse_mode='Markdown')
-
-            user.daily_queries += 1
-            user.last_query = datetime.now(SAUDI_TIMEZONE)
-            session.commit()
-
-            await asyncio.sleep(120)
-            await sent_message.delete()
+            reserved = None
+
+            # Removed two minutes later by the scheduler rather than by
+            # sleeping here, which would hold a concurrent-update slot
+            self.scheduler.add_job(
+                self.delete_message, 'date',
+                run_date=datetime.now(SAUDI_TIMEZONE) + timedelta(seconds=120),
+                args=[sent_message]
+            )
         except Exception as e:
             logging.error(f"Stock Analysis Error: {str(e)}", exc_info=True)
+            if reserved is not None:
+                # The reserved query was never answered; don't charge for it
+                try:
+                    async with Session.begin() as session:
+                        await session.execute(RELEASE_USER_QUERY, {'user_pk': reserved})
+                except Exception as e:
+                    logging.error(f"Release Query Error: {str(e)}", exc_info=True)
             await update.message.reply_text("⚠️ حدث خطأ في تحليل السهم، يرجى المحاولة لاحقًا")
-        finally:
-            session.close()
+
+    async def delete_message(self, message):
+        try:
+            await message.delete()
+        except Exception as e:
+            logging.error(f"Delete Message Error: {str(e)}")
 
     async def analyze_stock(self, stock_code):
+        # Outside the session the history can't change, so one download per
+        # symbol per completed session answers every query until the next open
+        market_open = self.is_trading_time()
+        session_day = self.last_session_day()
+        if market_open:
+            # Popular codes are asked for over and over within minutes
+            cached = self.analysis_cache.get(stock_code)
+            if cached:
+                return cached
+        else:
+            cached = self.closed_market_analysis.get(stock_code)
+            if cached and cached[0] == session_day:
+                return cached[1]
+
         try:
-            import yfinance as yf
-            stock = yf.Ticker(f"{stock_code}.SR")
-            hist = stock.history(period="1mo")
-            if hist.empty:
+            analysis = await asyncio.to_thread(self.render_analysis, stock_code)
+            if analysis is None:
                 return "⚠️ لا توجد بيانات متاحة لهذا السهم"
 
-            analysis = f"""
-📊 *تحليل فني ومالي لسهم {stock_code}*
-*المؤشرات الفنية:*
-- السعر الحالي: {hist['Close'].iloc[-1]:.2f} ريال
-- المتوسط المتحرك 50 يوم: {hist['Close'].rolling(50).mean().iloc[-1]:.2f}
-- مؤشر RSI: {self.calculate_rsi(hist):.2f}
-- مؤشر MACD: {self.calculate_macd(hist):.2f}
-*التوصية:* {'🟢 شراء' if hist['Close'].iloc[-1] > hist['Close'].rolling(200).mean().iloc[-1] else '🔴 بيع'}
-            """
+            if market_open:
+                self.analysis_cache[stock_code] = analysis
+            else:
+                self.closed_market_analysis[stock_code] = (session_day, analysis)
             return analysis
         except Exception as e:
             logging.error(f"Analysis Error: {str(e)}")
             return "⚠️ حدث خطأ في تحليل السهم، يرجى المحاولة لاحقًا"
 
-    def calculate_rsi(self, data, period=14):
-        delta = data['Close'].diff()
-        gain = (delta.where(delta > 0, 0)).rolling(period).mean()
-        loss = (-delta.where(delta < 0, 0)).rolling(period).mean()
-        rs = gain / loss
-        return 100 - (100 / (1 + rs)).iloc[-1]
+    def render_analysis(self, stock_code):
+        # Runs in a worker thread: the download and the indicator kernels
+        # (compiled nogil) stay off the event loop
+        import yfinance as yf
+        stock = yf.Ticker(f"{stock_code}.SR")
+        hist = stock.history(period="1mo")
+        if hist.empty:
+            return None
 
-    def calculate_macd(self, data):
-        exp12 = data['Close'].ewm(span=12, adjust=False).mean()
-        exp26 = data['Close'].ewm(span=26, adjust=False).mean()
-        return (exp12 - exp26).iloc[-1]
+        last_close = hist['Close'].iloc[-1]
+        rsi, macd, ma50, ma200 = technical_analysis.latest_indicators(hist['Close'])
 
-    async def check_opportunities(self):
-        session = Session()
-        try:
-            import yfinance as yf
-            for symbol in STOCK_SYMBOLS:
-                data = yf.download(symbol, period='3d', interval='1h')
-                if data.empty or len(data) < 200:
-                    continue
-
-                if self.detect_golden_cross(data):
-                    await self.create_opportunity(symbol, 'golden', data)
-                if self.detect_earthquake(data):
-                    await self.create_opportunity(symbol, 'earthquake', data)
-                if self.detect_volcano(data):
-                    await self.create_opportunity(symbol, 'volcano', data)
-                if self.detect_lightning(data):
-                    await self.create_opportunity(symbol, 'lightning', data)
-        except Exception as e:
-            logging.error(f"Opportunity Error: {str(e)}", exc_info=True)
-        finally:
-            session.close()
-
-    def detect_golden_cross(self, data):
-        ema50 = data['Close'].ewm(span=50, adjust=False).mean().iloc[-1]
-        ema200 = data['Close'].ewm(span=200, adjust=False).mean().iloc[-1]
-        return ema50 > ema200
-
-    def detect_earthquake(self, data):
-        return (data['Close'].iloc[-1] > data['High'].rolling(14).max().iloc[-2] 
-                and data['Volume'].iloc[-1] > data['Volume'].mean() * 2)
+        return f"""
+📊 *تحليل فني ومالي لسهم {stock_code}*
+*المؤشرات الفنية:*
+- السعر الحالي: {last_close:.2f} ريال
+- المتوسط المتحرك 50 يوم: {ma50:.2f}
+- مؤشر RSI: {rsi:.2f}
+- مؤشر MACD: {macd:.2f}
+*التوصية:* {'🟢 شراء' if last_close > ma200 else '🔴 بيع'}
+            """
 
-    def detect_volcano(self, data):
-        high = data['High'].max()
-        low = data['Low'].min()
-        return data['Close'].iloc[-1] > low + 0.618 * (high - low)
+    def is_trading_time(self):
+        now = datetime.now(SAUDI_TIMEZONE)
+        minute = now.hour * 60 + now.minute
+        return now.weekday() in TRADING_DAYS and TRADING_START_MINUTE <= minute <= TRADING_END_MINUTE
+
+    def last_session_day(self):
+        # Date of the most recent session that has already closed
+        now = datetime.now(SAUDI_TIMEZONE)
+        day = now.date()
+        if now.hour * 60 + now.minute <= TRADING_END_MINUTE:
+            day -= timedelta(days=1)
+        while day.weekday() not in TRADING_DAYS:
+            day -= timedelta(days=1)
+        return day
 
-    def detect_lightning(self, data):
-        return (data['High'].iloc[-1] - data['Low'].iloc[-1] 
-                > data['Close'].iloc[-2] * 0.05)
+    async def check_opportunities(self):
+        # Prices don't move outside the session, so skip the downloads entirely
+        if not self.is_trading_time():
+            return
 
-    async def create_opportunity(self, symbol, strategy, data):
-        session = Session()
         try:
-            entry_price = data['Close'].iloc[-1]
-            stop_loss = self.calculate_stop_loss(strategy, data)
-            targets = self.calculate_targets(strategy, entry_price)
-
-            opp = Opportunity(
-                symbol=symbol,
-                strategy=strategy,
-                entry_price=entry_price,
-                targets=targets,
-                stop_loss=stop_loss
-            )
-            session.add(opp)
-            session.commit()
+            # Download and detection both run off the event loop
+            signals, ema_state = await asyncio.to_thread(self.scan_signals)
+            # The EMA state only advances once the crosses it fired are
+            # stored, so a failed insert lets the next scan fire them again
+            if not signals:
+                self.ema_state.update(ema_state)
+                return
+            opportunities = [
+                self.create_opportunity(symbol, strategy, bars)
+                for symbol, strategy, bars in signals
+            ]
 
-            await self.send_alert_to_groups(opp)
+            # One transaction for the whole scan: the rows go out as a single
+            # multi-row INSERT and each strategy's subscribers are looked up
+            # alongside. The alerts are sent after it closes, so no
+            # connection is held through the broadcasts.
+            async with Session.begin() as session:
+                session.add_all(opportunities)
+                recipients = {
+                    strategy: await self.subscribed_chat_ids(session, strategy)
+                    for strategy in {opp.strategy for opp in opportunities}
+                }
+            self.ema_state.update(ema_state)
+            for opp in opportunities:
+                await self.send_alert_to_groups(opp, recipients[opp.strategy])
         except Exception as e:
-            logging.error(f"Create Opportunity Error: {str(e)}", exc_info=True)
-        finally:
-            session.close()
+            logging.error(f"Opportunity Error: {str(e)}", exc_info=True)
 
-    def calculate_stop_loss(self, strategy, data):
+    def scan_signals(self):
+        # Runs in a worker thread: the yfinance download and the pandas
+        # detector work would otherwise stall webhook handling on the loop.
+        import yfinance as yf
+        # Once every symbol has bars from today cached, only today's bars are
+        # fetched and merged in. The first scan of a session pulls the full
+        # window again, so the previous sessions' last bars are replaced by
+        # their final prints (closing auction, delayed feed) rather than
+        # staying frozen at what the last in-hours scan saw.
+        today = datetime.now(SAUDI_TIMEZONE).date()
+        warm = all(
+            symbol in self.bar_cache
+            and self.bar_cache[symbol].index[-1].tz_convert(SAUDI_TIMEZONE).date() == today
+            for symbol in STOCK_SYMBOLS
+        )
+        # One request for every symbol instead of a round trip each
+        frames = yf.download(
+            STOCK_TICKERS, period='1d' if warm else f'{SCAN_WINDOW_DAYS}d', interval='1h',
+            group_by='ticker', threads=True, progress=False
+        )
+        signals = []
+        # symbol -> EMA state to save once this scan's signals are stored
+        ema_state = {}
+        for symbol in STOCK_SYMBOLS:
+            data = frames.get(symbol)
+            if data is None:
+                continue
+            data = self.merge_bars(symbol, data.dropna(how='all'))
+            if data.empty or len(data) < 200:
+                continue
+
+            # The detectors only index into the tail of each column, so pull
+            # the columns out as arrays once instead of going through pandas
+            # indexers for every lookup
+            bars = Bars.from_frame(data)
+            crossed, ema_state[symbol] = self.detect_golden_cross(symbol, data)
+            if crossed:
+                signals.append((symbol, 'golden', bars))
+            flags = technical_analysis.detect_breakouts(*bars)
+            for strategy, triggered in zip(('earthquake', 'volcano', 'lightning'), flags):
+                if triggered:
+                    signals.append((symbol, strategy, bars))
+        return signals, ema_state
+
+    def merge_bars(self, symbol, bars):
+        cached = self.bar_cache.get(symbol)
+        if cached is not None:
+            # The forming bar is re-sent on every fetch; keep its newest copy
+            bars = pd.concat([cached, bars])
+            bars = bars[~bars.index.duplicated(keep='last')].sort_index()
+        if bars.empty:
+            return bars
+
+        # Trim to the trading days a full download would have returned
+        days = bars.index.normalize()
+        bars = bars[days >= days.unique()[-SCAN_WINDOW_DAYS:].min()]
+        self.bar_cache[symbol] = bars
+        return bars
+
+    def detect_golden_cross(self, symbol, data):
+        closes = data['Close']
+        # The last bar is still forming, so only completed bars are folded
+        # into the running EMAs; each run then costs O(new bars) instead of
+        # a pass over the whole window.
+        completed = closes.iloc[:-1]
+        state = self.ema_state.get(symbol)
+        if state is None:
+            ema50 = completed.ewm(span=50, adjust=False).mean().iloc[-1]
+            ema200 = completed.ewm(span=200, adjust=False).mean().iloc[-1]
+            # A trend already in place when the bot starts isn't a new cross
+            was_above = ema50 > ema200
+        else:
+            last_bar, ema50, ema200, was_above = state
+            for close in completed[completed.index > last_bar]:
+                ema50 = technical_analysis.ema_step(ema50, close, 50)
+                ema200 = technical_analysis.ema_step(ema200, close, 200)
+
+        close = closes.iloc[-1]
+        above = technical_analysis.ema_step(ema50, close, 50) > technical_analysis.ema_step(ema200, close, 200)
+        # Fire on the crossing itself, not on every scan while EMA50 stays on
+        # top. The new state is returned rather than saved here; the caller
+        # stores it once the signal has been recorded.
+        return above and not was_above, (completed.index[-1], ema50, ema200, above)
+
+    def create_opportunity(self, symbol, strategy, bars):
+        entry_price = bars.close[-1]
+        stop_loss = self.calculate_stop_loss(strategy, bars)
+        targets = self.calculate_targets(strategy, entry_price)
+
+        return Opportunity(
+            symbol=symbol,
+            strategy=strategy,
+            entry_price=entry_price,
+            targets=targets,
+            stop_loss=stop_loss
+        )
+
+    def calculate_stop_loss(self, strategy, bars):
         if strategy == 'golden':
-            return data['Low'].iloc[-2] * 0.98
+            return bars.low[-2] * 0.98
         elif strategy == 'earthquake':
-            return data['Close'].iloc[-1] * 0.95
+            return bars.close[-1] * 0.95
         else:
-            return data['Close'].iloc[-1] * 0.97
+            return bars.close[-1] * 0.97
 
     def calculate_targets(self, strategy, entry):
-        strategies = {
-            'golden': [round(entry * (1 + i*0.05), 2) for i in range(1,5)],
-            'earthquake': [round(entry * (1 + i*0.08), 2) for i in range(1,3)],
-            'volcano': [round(entry * (1 + i*0.1), 2) for i in range(1,6)],
-            'lightning': [round(entry * (1 + i*0.07), 2) for i in range(1,3)]
-        }
-        return strategies.get(strategy, [])
-
-    async def send_alert_to_groups(self, opportunity):
-        session = Session()
+        multipliers = TARGET_MULTIPLIERS.get(strategy)
+        if multipliers is None:
+            return []
+        return np.round(entry * multipliers, 2).tolist()
+
+    async def subscribed_chat_ids(self, session, strategy):
+        return (await session.scalars(select(Group.chat_id).filter(
+            Group.chat_id.in_(ACTIVATED_GROUPS),
+            Group.settings.contains({'strategies': {strategy: True}})
+        ))).all()
+
+    async def send_alert_to_groups(self, opportunity, chat_ids):
         try:
-            groups = session.query(Group).filter(
-                Group.chat_id.in_(ACTIVATED_GROUPS),
-                Group.settings['strategies'][opportunity.strategy].as_boolean()
-            ).all()
-
-            text = (
-                f"🚨 إشارة {self.get_strategy_name(opportunity.strategy)}\n"
-                f"📈 السهم: {opportunity.symbol}\n"
-                f"💰 السعر: {opportunity.entry_price:.2f}\n"
-                f"🎯 الأهداف: {', '.join(map(str, opportunity.targets))}\n"
-                f"🛑 وقف الخسارة: {opportunity.stop_loss:.2f}"
-            )
+            if not chat_ids:
+                return
 
-            for group in groups:
-                await self.app.bot.send_message(
-                    chat_id=group.chat_id,
-                    text=text,
-                    parse_mode='HTML'
-                )
+            text = ALERT_TEMPLATE.format(
+                strategy=self.get_strategy_name(opportunity.strategy),
+                symbol=opportunity.symbol,
+                entry_price=opportunity.entry_price,
+                targets=', '.join(map(str, opportunity.targets)),
+                stop_loss=opportunity.stop_loss
+            )
+            # Plain text: the alert has no markup for Telegram to parse
+            await self.broadcast([(chat_id, text) for chat_id in chat_ids])
         except Exception as e:
             logging.error(f"Alert Error: {str(e)}", exc_info=True)
-        finally:
-            session.close()
+
+    async def broadcast(self, messages, parse_mode=None):
+        """Send (chat_id, text) pairs concurrently within Telegram's rate limit."""
+        loop = asyncio.get_running_loop()
+
+        async def send(chat_id, text):
+            # Reserve this chat's next slot before sleeping, so back-to-back
+            # alerts to one group are spaced out instead of hitting flood control
+            now = loop.time()
+            slot = max(now, self.chat_next_send[chat_id])
+            self.chat_next_send[chat_id] = slot + CHAT_SEND_INTERVAL
+            if slot > now:
+                await asyncio.sleep(slot - now)
+
+            async with self.send_semaphore, self.send_limiter:
+                # One failing chat (blocked bot, deleted group) must not
+                # cancel the rest of the fan-out
+                try:
+                    try:
+                        await self.app.bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode)
+                    except RetryAfter as e:
+                        # Flood control: back off this send only, then retry once
+                        await asyncio.sleep(e.retry_after)
+                        await self.app.bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode)
+                except Exception as e:
+                    logging.error(f"Send Error ({chat_id}): {str(e)}")
+
+        await asyncio.gather(*(send(chat_id, text) for chat_id, text in messages))
 
     def get_strategy_name(self, strategy):
-        names = {
-            'golden': 'ذهبية 💰',
-            'earthquake': 'زلزالية 🌋',
-            'volcano': 'بركانية 🌋',
-            'lightning': 'برقية ⚡'
-        }
-        return names.get(strategy, 'غير معروفة')
+        return STRATEGY_NAMES.get(strategy, 'غير معروفة')
 
     async def reset_daily_queries(self):
-        session = Session()
         try:
-            session.query(User).update({User.daily_queries: 0})
-            session.commit()
+            async with Session.begin() as session:
+                await session.execute(RESET_DAILY_QUERIES)
         except Exception as e:
             logging.error(f"Reset Queries Error: {str(e)}", exc_info=True)
-        finally:
-            session.close()
 
     async def check_penalties(self):
-        session = Session()
         try:
-            penalties = session.query(Penalty).filter(Penalty.end_time <= datetime.now(SAUDI_TIMEZONE)).all()
+            # One joined query for the columns we need, then one bulk DELETE,
+            # instead of loading penalty -> user -> group objects and deleting
+            # them row by row. The Telegram calls happen between the two
+            # transactions so no connection sits idle in a transaction.
+            async with Session.begin() as session:
+                penalties = (await session.execute(
+                    select(Penalty.id, Penalty.penalty_type, User.user_id, Group.chat_id)
+                    .join(Penalty.user)
+                    .join(User.group)
+                    .filter(Penalty.end_time <= datetime.now(SAUDI_TIMEZONE))
+                )).all()
+            if not penalties:
+                return
+
             for penalty in penalties:
-                if penalty.penalty_type == 'mute':
+                if penalty.penalty_type != 'mute':
+                    continue
+                # A user who left, or a chat where the bot lost admin, must
+                # not keep the other expired penalties from being cleared
+                try:
                     await self.app.bot.restrict_chat_member(
-                        chat_id=penalty.user.group.chat_id,
-                        user_id=penalty.user.user_id,
+                        chat_id=penalty.chat_id,
+                        user_id=penalty.user_id,
                         permissions=ChatPermissions.all_permissions()
                     )
-                session.delete(penalty)
-                session.commit()
+                except Exception as e:
+                    logging.error(f"Unmute Error ({penalty.chat_id}/{penalty.user_id}): {str(e)}")
+
+            async with Session.begin() as session:
+                await session.execute(
+                    delete(Penalty).where(Penalty.id.in_([penalty.id for penalty in penalties]))
+                )
         except Exception as e:
             logging.error(f"Penalty Check Error: {str(e)}", exc_info=True)
-        finally:
-            session.close()
 
     async def send_daily_report(self):
-        session = Session()
-        try:
-            groups = session.query(Group).filter(Group.chat_id.in_(ACTIVATED_GROUPS)).all()
-            for group in groups:
-                if group.settings['reports']['daily']:
-                    report_text = (
-                        f"📊 *التقرير اليومي*\n"
-                        f"📅 التاريخ: {datetime.now(SAUDI_TIMEZONE).strftime('%Y-%m-%d')}\n"
-                        f"⏰ الوقت: {datetime.now(SAUDI_TIMEZONE).strftime('%H:%M')}\n\n"
-                        f"📈 عدد الفرص اليوم: {len(group.opportunities)}\n"
-                        f"👥 عدد المستخدمين النشطين: {session.query(User).filter_by(group_id=group.id).count()}"
-                    )
-
-                    await self.app.bot.send_message(
-                        chat_id=group.chat_id,
-                        text=report_text,
-                        parse_mode='Markdown'
-                    )
-        except Exception as e:
-            logging.error(f"Daily Report Error: {str(e)}", exc_info=True)
-        finally:
-            session.close()
+        await self.send_report('daily')
 
     async def send_weekly_report(self):
-        session = Session()
+        await self.send_report('weekly')
+
+    async def send_report(self, kind):
+        header_template, body_template = REPORT_TEMPLATES[kind]
         try:
-            groups = session.query(Group).filter(Group.chat_id.in_(ACTIVATED_GROUPS)).all()
-            for group in groups:
-                if group.settings['reports']['weekly']:
-                    report_text = (
-                        f"📊 *التقرير الأسبوعي*\n"
-                        f"📅 الأسبوع: {datetime.now(SAUDI_TIMEZONE).strftime('%Y-%U')}\n"
-                        f"⏰ الوقت: {datetime.now(SAUDI_TIMEZONE).strftime('%H:%M')}\n\n"
-                        f"📈 عدد الفرص الأسبوعية: {len(group.opportunities)}\n"
-                        f"👥 عدد المستخدمين النشطين: {session.query(User).filter_by(group_id=group.id).count()}"
-                    )
+            # Rows are fetched before the session closes, so the connection
+            # goes back to the pool before the rate-limited fan-out starts
+            async with Session() as session:
+                rows = (await session.execute(REPORT_COUNTS_BY_GROUP, {
+                    'chat_ids': list(ACTIVATED_GROUPS),
+                    'settings': {'reports': {kind: True}}
+                })).all()
+
+            # The header is the same for every group; render it once per run
+            header = header_template.format(now=datetime.now(SAUDI_TIMEZONE))
+            messages = [
+                (chat_id, header + body_template.format(opportunities=opportunities, users=users))
+                for chat_id, users, opportunities in rows
+            ]
 
-                    await self.app.bot.send_message(
-                        chat_id=group.chat_id,
-                        text=report_text,
-                        parse_mode='Markdown'
-                    )
+            await self.broadcast(messages, parse_mode='Markdown')
         except Exception as e:
-            logging.error(f"Weekly Report Error: {str(e)}", exc_info=True)
-        finally:
-            session.close()
+            logging.error(f"{kind.capitalize()} Report Error: {str(e)}", exc_info=True)
+
+# The bot and its scheduler start on uvicorn's event loop, so scheduled
+# jobs and webhook updates share one loop, one HTTP pool and one set of caches.
+@app.on_event("startup")
+async def startup():
+    await bot.run()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await bot.stop()
 
 # Webhook handler for FastAPI
 @app.post("/")
 async def webhook_handler(request: Request):
     data = await request.json()
     update = Update.de_json(data, bot.app.bot)
-    await bot.app.process_update(update)
+    # Acknowledge right away; handlers (a stock analysis keeps its reply up
+    # for two minutes) run from the queue, concurrently across updates
+    await bot.app.update_queue.put(update)
     return Response(status_code=200)
 
 # Initialize bot
@@ -552,10 +1009,8 @@ if __name__ == '__main__':
         level=logging.INFO
     )
 
-    # Start the bot in a separate thread
-    import threading
-    threading.Thread(target=asyncio.run, args=(bot.run(),)).start()
-
-    # Start FastAPI app
+    # Start FastAPI app; the bot is started from its startup hook.
+    # loop='auto' picks uvloop (from uvicorn[standard]) when it is installed,
+    # so the bot, scheduler and webhook all run on it.
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=PORT)
\ No newline at end of file
+    uvicorn.run(app, host="0.0.0.0", port=PORT, loop='auto')
\ No newline at end of file
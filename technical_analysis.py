@@ -1,6 +1,18 @@
 import pandas as pd
 import numpy as np
 
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    # numba is optional; without it the indicators use the pandas paths.
+    NUMBA_AVAILABLE = False
+
+    def njit(*args, **kwargs):
+        if args and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
 def calculate_all_indicators(data):
     closes = data['Close']
     highs = data['High']
@@ -14,19 +26,233 @@ def calculate_all_indicators(data):
     }
 
 def calculate_rsi(series, period=14):
-    delta = series.diff()
-    gain = (delta.where(delta > 0, 0)).fillna(0)
-    loss = (-delta.where(delta < 0, 0)).fillna(0)
+    closes = series.dropna()
+    if NUMBA_AVAILABLE:
+        rsi = _wilder_rsi(closes.to_numpy(dtype=np.float64), period)
+        return pd.Series(rsi, index=closes.index).reindex(series.index)
+
+    delta = closes.diff()
+    gain = delta.clip(lower=0)
+    loss = -delta.clip(upper=0)
     
-    avg_gain = gain.rolling(period).mean()
-    avg_loss = loss.rolling(period).mean()
+    avg_gain = _wilder_mean(gain, period)
+    avg_loss = _wilder_mean(loss, period)
     
     rs = avg_gain / avg_loss
-    return 100 - (100 / (1 + rs))
+    return (100 - (100 / (1 + rs))).reindex(series.index)
+
+def _wilder_mean(values, period):
+    # Wilder's RMA seeded like TA-Lib: the simple mean of the first `period`
+    # moves, then ewm(alpha=1/period) carries the recursion in one C pass.
+    # Matches _wilder_rsi exactly, so results don't depend on numba.
+    seeded = pd.Series(np.nan, index=values.index)
+    if len(values) <= period:
+        return seeded
+    seeded.iloc[period] = values.iloc[1:period + 1].mean()
+    seeded.iloc[period + 1:] = values.iloc[period + 1:]
+    return seeded.ewm(alpha=1 / period, adjust=False).mean()
+
+@njit(cache=True, nogil=True)
+def _wilder_rsi(closes, period):
+    # Single pass: seed with the simple mean of the first `period` moves,
+    # then carry Wilder's running averages in scalars.
+    n = closes.shape[0]
+    rsi = np.full(n, np.nan)
+    if n <= period:
+        return rsi
+
+    avg_gain = 0.0
+    avg_loss = 0.0
+    for i in range(1, n):
+        delta = closes[i] - closes[i - 1]
+        gain = delta if delta > 0 else 0.0
+        loss = -delta if delta < 0 else 0.0
+        if i <= period:
+            avg_gain += gain / period
+            avg_loss += loss / period
+            if i < period:
+                continue
+        else:
+            avg_gain = (avg_gain * (period - 1) + gain) / period
+            avg_loss = (avg_loss * (period - 1) + loss) / period
+
+        if avg_loss > 0:
+            rsi[i] = 100 - 100 / (1 + avg_gain / avg_loss)
+        elif avg_gain > 0:
+            rsi[i] = 100.0
+    return rsi
+
+def calculate_macd(series, fast=12, slow=26):
+    closes = series.dropna()
+    if NUMBA_AVAILABLE:
+        macd = _macd_line(closes.to_numpy(dtype=np.float64), fast, slow)
+        return pd.Series(macd, index=closes.index).reindex(series.index)
+
+    ema_fast = closes.ewm(span=fast, adjust=False).mean()
+    ema_slow = closes.ewm(span=slow, adjust=False).mean()
+    return (ema_fast - ema_slow).reindex(series.index)
+
+@njit(cache=True, nogil=True)
+def _macd_line(closes, fast, slow):
+    # Both EMAs advance in the same loop (same recursion as ewm(adjust=False))
+    n = closes.shape[0]
+    macd = np.empty(n)
+    if n == 0:
+        return macd
+
+    fast_alpha = 2.0 / (fast + 1)
+    slow_alpha = 2.0 / (slow + 1)
+    ema_fast = closes[0]
+    ema_slow = closes[0]
+    macd[0] = 0.0
+    for i in range(1, n):
+        ema_fast += fast_alpha * (closes[i] - ema_fast)
+        ema_slow += slow_alpha * (closes[i] - ema_slow)
+        macd[i] = ema_fast - ema_slow
+    return macd
+
+def latest_indicators(series, rsi_period=14, fast=12, slow=26):
+    # Latest RSI, MACD line, SMA50 and SMA200 -- everything the stock
+    # analysis reports -- without materialising a series for each
+    closes = series.dropna()
+    if NUMBA_AVAILABLE:
+        return _latest_indicators(closes.to_numpy(dtype=np.float64), rsi_period, fast, slow)
+
+    return (
+        calculate_rsi(closes, rsi_period).iloc[-1],
+        calculate_macd(closes, fast, slow).iloc[-1],
+        closes.iloc[-50:].mean() if len(closes) >= 50 else np.nan,
+        closes.iloc[-200:].mean() if len(closes) >= 200 else np.nan
+    )
+
+@njit(cache=True, nogil=True)
+def _latest_indicators(closes, rsi_period, fast, slow):
+    # One pass over the closes: Wilder RSI (same seeding as _wilder_rsi),
+    # both MACD EMAs and the trailing sums for the two SMAs
+    n = closes.shape[0]
+    rsi = np.nan
+    macd = np.nan
+    sma50 = np.nan
+    sma200 = np.nan
+    if n == 0:
+        return rsi, macd, sma50, sma200
+
+    fast_alpha = 2.0 / (fast + 1)
+    slow_alpha = 2.0 / (slow + 1)
+    ema_fast = closes[0]
+    ema_slow = closes[0]
+    avg_gain = 0.0
+    avg_loss = 0.0
+    sum50 = closes[0] if n <= 50 else 0.0
+    sum200 = closes[0] if n <= 200 else 0.0
+    for i in range(1, n):
+        close = closes[i]
+        if i >= n - 50:
+            sum50 += close
+        if i >= n - 200:
+            sum200 += close
+
+        ema_fast += fast_alpha * (close - ema_fast)
+        ema_slow += slow_alpha * (close - ema_slow)
+
+        delta = close - closes[i - 1]
+        gain = delta if delta > 0 else 0.0
+        loss = -delta if delta < 0 else 0.0
+        if i <= rsi_period:
+            avg_gain += gain / rsi_period
+            avg_loss += loss / rsi_period
+        else:
+            avg_gain = (avg_gain * (rsi_period - 1) + gain) / rsi_period
+            avg_loss = (avg_loss * (rsi_period - 1) + loss) / rsi_period
+
+    macd = ema_fast - ema_slow
+    if n > rsi_period:
+        if avg_loss > 0:
+            rsi = 100 - 100 / (1 + avg_gain / avg_loss)
+        elif avg_gain > 0:
+            rsi = 100.0
+    if n >= 50:
+        sma50 = sum50 / 50
+    if n >= 200:
+        sma200 = sum200 / 200
+    return rsi, macd, sma50, sma200
+
+def detect_breakouts(high, low, close, volume, lookback=14, fib_ratio=0.618, range_ratio=0.05):
+    # (earthquake, volcano, lightning) for the latest bar: close above the
+    # `lookback`-bar high with double the average volume, close above the
+    # 0.618 retracement of the window's range, and a bar range wider than
+    # `range_ratio` of the previous close
+    if NUMBA_AVAILABLE:
+        return _breakout_flags(
+            np.asarray(high, dtype=np.float64), np.asarray(low, dtype=np.float64),
+            np.asarray(close, dtype=np.float64), np.asarray(volume, dtype=np.float64),
+            lookback, fib_ratio, range_ratio
+        )
+
+    top = np.nanmax(high)
+    bottom = np.nanmin(low)
+    return (
+        bool(close[-1] > high[-lookback - 1:-1].max() and volume[-1] > np.nanmean(volume) * 2),
+        bool(close[-1] > bottom + fib_ratio * (top - bottom)),
+        bool(high[-1] - low[-1] > close[-2] * range_ratio)
+    )
+
+@njit(cache=True, nogil=True)
+def _breakout_flags(high, low, close, volume, lookback, fib_ratio, range_ratio):
+    # One pass collects the window's high/low, the volume mean and the
+    # breakout level that the three checks would otherwise each sweep for
+    n = close.shape[0]
+    if n < 2:
+        return False, False, False
+
+    top = -np.inf
+    bottom = np.inf
+    volume_sum = 0.0
+    volume_count = 0
+    breakout = -np.inf
+    for i in range(n):
+        h = high[i]
+        if h > top:
+            top = h
+        if low[i] < bottom:
+            bottom = low[i]
+        if volume[i] == volume[i]:
+            volume_sum += volume[i]
+            volume_count += 1
+        if n - 1 - lookback <= i < n - 1:
+            # A gap in the lookback leaves no level to break, as with max()
+            if h != h or h > breakout:
+                breakout = h
+
+    last = close[n - 1]
+    earthquake = (volume_count > 0 and last > breakout
+                  and volume[n - 1] > volume_sum / volume_count * 2)
+    volcano = last > bottom + fib_ratio * (top - bottom)
+    lightning = high[n - 1] - low[n - 1] > close[n - 2] * range_ratio
+    return earthquake, volcano, lightning
+
+def ema_step(prev, value, span):
+    # One step of the ewm(span=..., adjust=False) recursion, for callers that
+    # keep the running EMA instead of recomputing it over the whole history
+    return prev + 2.0 / (span + 1) * (value - prev)
 
 def calculate_moving_average(series, window):
+    if NUMBA_AVAILABLE:
+        # pandas' own JIT'd rolling kernel, compiled once per process
+        return series.rolling(window).mean(engine='numba', engine_kwargs={'nopython': True, 'nogil': True})
     return series.rolling(window).mean()
 
+def warmup():
+    # Compile (or load from the on-disk cache) the kernels the bot calls --
+    # the analysis and the opportunity scan -- so the first request doesn't
+    # pay for it. Same argument types as the real calls, otherwise numba
+    # compiles another specialisation.
+    if not NUMBA_AVAILABLE:
+        return
+    closes = np.linspace(1.0, 2.0, 300)
+    _latest_indicators(closes, 14, 12, 26)
+    _breakout_flags(closes, closes, closes, closes, 14, 0.618, 0.05)
+
 def calculate_fib_levels(high, low):
     diff = high - low
     return {